@@ -17,25 +17,69 @@
 This code uses Google Vision API to detect the text in a raster map. Then, it
 sends the results to Google Geocoding API to guess where the map belongs to.
 """
+import asyncio
+from concurrent import futures
+import functools
 import re
 import googlemaps
+import requests
 
 from google.cloud import language
 from google.cloud import vision
 from google.cloud.language import enums
 from google.cloud.language import types
+from util import clients
+
+_HTTP_POOL_SIZE = 16
+
+# Bounds the concurrent Geocoding requests; tune to the API key's quota.
+_GEOCODING_EXECUTOR = futures.ThreadPoolExecutor(max_workers=5)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_clients(api_key):
+  """Returns the (geocoding, vision, nlp) clients, created once per process."""
+  session = requests.Session()
+  session.mount('https://', requests.adapters.HTTPAdapter(
+      pool_connections=_HTTP_POOL_SIZE, pool_maxsize=_HTTP_POOL_SIZE))
+  return (googlemaps.Client(key=api_key, requests_session=session),
+          clients.get_vision_client(),
+          clients.get_language_client())
+
+
+_PUNCTUATION = re.compile(r'[^\w\s]+')
+
+
+def _normalize_query(query):
+  """Lowercases the query, drops punctuation and collapses whitespace."""
+  return ' '.join(_PUNCTUATION.sub(' ', query.lower()).split())
+
+
+@functools.lru_cache(maxsize=10000)
+def _cached_geocode(gmaps, normalized_query):
+  """Geocodes a normalized query, reusing results for the lifetime of the process."""
+  return gmaps.geocode(normalized_query)
 
 
 class Geolocalizer(object):
   """Geolocalizes a given raster map."""
   _CONFIDENCE_THRESHOLD = 0.9
+  _NON_ALPHANUMERIC = re.compile('[^0-9A-Za-z]+')
+  _ADDRESS_ENTITY_TYPES = frozenset((enums.Entity.Type.ADDRESS,
+                                     enums.Entity.Type.LOCATION))
 
-  def __init__(self, api_key):
+  def __init__(self, api_key, max_words_without_nlp=8):
+    """Creates a geolocalizer.
+
+    Args:
+      api_key: Google Maps Geocoding API key.
+      max_words_without_nlp: Texts with at most this many words are sent
+        straight to the Geocoding API, skipping the NLP entity analysis.
+    """
     if not api_key:
       raise ValueError('A Google Maps Geocoding API key is required.')
-    self.gmaps = googlemaps.Client(key=api_key)
-    self.vision_client = vision.ImageAnnotatorClient()
-    self.nlp_client = language.LanguageServiceClient()
+    self.gmaps, self.vision_client, self.nlp_client = _get_clients(api_key)
+    self.max_words_without_nlp = max_words_without_nlp
 
   def _detect_texts(self, uri):
     """Detects text in the file given by a uri."""
@@ -43,7 +87,8 @@ class Geolocalizer(object):
       raise ValueError('No URI was given.')
     image = vision.types.Image()
     image.source.image_uri = uri
-    response = self.vision_client.document_text_detection(image=image)
+    response = self.vision_client.document_text_detection(
+        image=image, retry=clients.RETRY, timeout=clients.TIMEOUT_SECONDS)
     if response.error.code:
       raise Exception('Something went wrong with the Vision API:' +
                       str(response.error))
@@ -55,52 +100,87 @@ class Geolocalizer(object):
     """Processes the recognized texts and combines them to form a text corpus."""
     if not texts:
       return None
-    words = ''
+    parts = []
+    # Bound to locals since these loops run for every recognized symbol.
+    extend = parts.extend
+    confidence_threshold = self._CONFIDENCE_THRESHOLD
     for block in texts.blocks:
       for paragraph in block.paragraphs:
-        if paragraph.confidence < self._CONFIDENCE_THRESHOLD:
+        if paragraph.confidence < confidence_threshold:
           continue
         for word in paragraph.words:
-          symbols = ''
-          for symbol in word.symbols:
-            symbols += symbol.text
-            # Add a space for breaks.
-            if symbol.property.detected_break.type is not 0:
-              symbols += ' '
-          words += symbols
+          # Add a space for breaks.
+          extend([
+              symbol.text + ' ' if symbol.property.detected_break.type
+              else symbol.text for symbol in word.symbols])
+    words = ''.join(parts)
     # Remove special characters. More processing can happen here, such as
     # removing stop words, etc.
-    words = re.sub('[^0-9A-Za-z]+', ' ', words)
+    words = self._NON_ALPHANUMERIC.sub(' ', words).strip()
     if not words:
       return None
+    # Sparse maps only have a few labels, which are geocoded as they are.
+    if len(words.split()) <= self.max_words_without_nlp:
+      return [words]
     addressess = self._analyze_entities(words)
     return addressess
 
   def _analyze_entities(self, text):
     """Analyzez the text and derives insights from it, such as addresses and locations"""
     document = language.types.Document(content=text,type=language.enums.Document.Type.PLAIN_TEXT)
-    response = self.nlp_client.analyze_entities(document=document, encoding_type='UTF32')
-    addresses = ''
-    for entity in response.entities:
-      if entity.type == enums.Entity.Type.ADDRESS or entity.type == enums.Entity.Type.LOCATION:
-        addresses += entity.name + ' '
-    return addresses
-
-  def _geocode(self, text):
-    """Returns the candidate geolocation for a textual query."""
-    if not text:
-      return None
-    geocoding_results = self.gmaps.geocode(text)
-    if not geocoding_results:
+    response = self.nlp_client.analyze_entities(
+        document=document, encoding_type='UTF32', retry=clients.RETRY,
+        timeout=clients.TIMEOUT_SECONDS)
+    address_types = self._ADDRESS_ENTITY_TYPES
+    return [entity.name for entity in response.entities
+            if entity.type in address_types]
+
+  def _geocode(self, queries):
+    """Returns the candidate geolocations for the textual queries.
+
+    Each query is geocoded separately and concurrently. Every candidate
+    location is tagged with the query it came from.
+    """
+    if not queries:
       return None
+    gmaps = self.gmaps
+    # Keyed by the normalized query so repeated OCR of a place is sent once.
+    normalized_queries = {}
+    for query in queries:
+      normalized = _normalize_query(query)
+      if normalized:
+        normalized_queries.setdefault(normalized, query)
+    all_results = _GEOCODING_EXECUTOR.map(
+        lambda normalized: _cached_geocode(gmaps, normalized),
+        normalized_queries, timeout=clients.TIMEOUT_SECONDS)
     candidates = []
-    for result in geocoding_results:
-      candidates.append(result['geometry']['location'])
+    for query, geocoding_results in zip(normalized_queries.values(),
+                                        all_results):
+      for result in geocoding_results or ():
+        candidates.append(dict(result['geometry']['location'], query=query))
+    if not candidates:
+      return None
     return candidates
 
   def geolocalize(self, uri):
     """Returns the geolocaltion of an image given by the uri."""
     texts = self._detect_texts(uri)
-    text_blob = self._process_and_combine_texts(texts)
-    candidates = self._geocode(text_blob)
-    return (text_blob, candidates)
+    addresses = self._process_and_combine_texts(texts)
+    candidates = self._geocode(addresses)
+    return (self._join_addresses(addresses), candidates)
+
+  @staticmethod
+  def _join_addresses(addresses):
+    """Returns the addresses as a single text blob."""
+    if addresses is None:
+      return None
+    return ' '.join(addresses)
+
+  async def geolocalize_async(self, uri):
+    """Coroutine version of `geolocalize` for callers running an event loop.
+
+    The blocking pipeline runs in the loop's default executor, so several
+    maps can be geolocalized concurrently with `asyncio.gather`.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, self.geolocalize, uri)
@@ -1,11 +1,19 @@
 """Main module for setting up google cloud function
 https://cloud.google.com/functions/docs/writing/
 """
+import functools
 import os
 import json
 
 from geolocalizer import Geolocalizer
 
+
+@functools.lru_cache(maxsize=1)
+def _get_geolocalizer(api_key):
+    """Returns a Geolocalizer reused across warm invocations."""
+    return Geolocalizer(api_key)
+
+
 def geolocalize_map(request):
     """
     Args:
@@ -25,7 +33,6 @@ def geolocalize_map(request):
     if not API_KEY:
         return f'No API_KEY found'
 
-    # TODO(zhouwubai): make it singleton
-    geolocalizer = Geolocalizer(API_KEY)
+    geolocalizer = _get_geolocalizer(API_KEY)
     text, candidates = geolocalizer.geolocalize(uri)
     return json.dumps({"text": text, "candidates": candidates})
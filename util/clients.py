@@ -0,0 +1,64 @@
+# Copyright 2021 The Kartta Labs Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Google Cloud API clients shared by the geolocalizer modules.
+
+The clients are created once per process so that warm invocations reuse
+their gRPC channels.
+"""
+from functools import lru_cache
+
+from google.api_core import exceptions
+from google.api_core import retry
+from google.cloud import language
+from google.cloud import vision
+from google.cloud.language_v1.gapic.transports import language_service_grpc_transport
+from google.cloud.vision_v1.gapic.transports import image_annotator_grpc_transport
+
+# Keeps idle channels alive between warm invocations. The message length
+# options are the defaults of the generated transports, which are lost when
+# passing our own options.
+GRPC_CHANNEL_OPTIONS = [
+    ('grpc.max_send_message_length', -1),
+    ('grpc.max_receive_message_length', -1),
+    ('grpc.keepalive_time_ms', 30000),
+    ('grpc.keepalive_timeout_ms', 10000),
+    ('grpc.http2.max_pings_without_data', 0),
+]
+
+# Retries throttled and transiently unavailable calls with exponential
+# backoff and jitter.
+RETRY = retry.Retry(
+    predicate=retry.if_exception_type(exceptions.ResourceExhausted,
+                                      exceptions.ServiceUnavailable,
+                                      exceptions.DeadlineExceeded),
+    initial=0.5, maximum=10.0, multiplier=2.0, deadline=120.0)
+TIMEOUT_SECONDS = 60.0
+
+
+@lru_cache(maxsize=1)
+def get_vision_client():
+  """Returns the Vision API client, created once per process."""
+  transport = image_annotator_grpc_transport.ImageAnnotatorGrpcTransport
+  return vision.ImageAnnotatorClient(transport=transport(
+      channel=transport.create_channel(options=GRPC_CHANNEL_OPTIONS)))
+
+
+@lru_cache(maxsize=1)
+def get_language_client():
+  """Returns the Natural Language API client, created once per process."""
+  transport = language_service_grpc_transport.LanguageServiceGrpcTransport
+  return language.LanguageServiceClient(transport=transport(
+      channel=transport.create_channel(options=GRPC_CHANNEL_OPTIONS)))
@@ -23,20 +23,46 @@ patches to the Vision API.
 from __future__ import division
 from __future__ import print_function
 
-from functools import partial
+from concurrent import futures
+from functools import lru_cache
 import io
-import os
-import tempfile
+import logging
+import math
 import uuid
 
 from enum import Enum
 from PIL import Image
 
+from google.api_core import exceptions
 from google.cloud import storage
 from google.cloud import vision
+from google.protobuf import json_format
 
-vision_client = vision.ImageAnnotatorClient()
-storage_client = storage.Client()
+from util import clients
+
+# Shared by every split level; OCR calls are I/O bound so threads suffice.
+_EXECUTOR = futures.ThreadPoolExecutor(max_workers=8)
+
+# Max number of images the Vision API accepts in one BatchAnnotateImages call.
+_MAX_IMAGES_PER_BATCH = 16
+
+# Max number of responses the Vision API writes to one asynchronous output file.
+_MAX_RESPONSES_PER_OUTPUT_FILE = 100
+
+# How long to wait for an asynchronous batch to finish.
+_ASYNC_TIMEOUT_SECONDS = 600
+
+# Image modes that can be saved as PNG without conversion.
+_PNG_MODES = frozenset(('1', 'L', 'LA', 'I', 'P', 'RGB', 'RGBA'))
+
+# Shortest edge, in pixels, below which downscaling hurts OCR accuracy.
+_MIN_OCR_EDGE = 1200
+
+
+@lru_cache(maxsize=1)
+def _get_storage_client():
+  """Returns the Cloud Storage client, created once per process."""
+  return storage.Client()
 
 
 class Axis(Enum):
@@ -44,95 +70,314 @@ class Axis(Enum):
   HORIZONTAL = 'x'
 
 
-def call_vision_api(uri, max_size_megabytes=20, overlap=0.25):
-  """Stores image in local directory, calls the vision API, and returns the response.
+class _Tile(object):
+  """An encoded image, or a future of one, and the factor it was downscaled by."""
+
+  def __init__(self, content, scale=1.0):
+    self._content = content
+    self.scale = scale
+
+  @property
+  def image(self):
+    """The Vision API image, waiting for the encoding if needed."""
+    content = self._content
+    if isinstance(content, futures.Future):
+      content = content.result()
+    return vision.types.Image(content=content)
+
+
+def call_vision_api(uri, max_size_megabytes=20, overlap=0.25,
+                    scratch_bucket=None):
+  """Downloads the image into memory, calls the vision API, and returns the response.
 
   Args:
     uri: 'https://i.stack.imgur.com/WiDpa.jpg'.
     max_size_megabytes: Max size of a file specified by the Vision API.
     overlap: Customizable overlap percentage.
+    scratch_bucket: Optional Cloud Storage bucket name. When given and the
+      image is split into more tiles than fit in one batch, the tiles are
+      sent through a single asynchronous batch request instead.
 
   Returns:
   Response of the Vision API (https://cloud.google.com/vision/docs/ocr).
   """
   if not uri:
     raise ValueError('Please provide a URI.')
-  folder_name = tempfile.mkdtemp()
-  image_file = folder_name + '/original'
-
-  with open(image_file, 'w') as file_obj:
-    storage_client.download_blob_to_file(uri, file_obj)
-  return _call_vision_api_helper(image_file, max_size_megabytes, overlap)
+  buf = io.BytesIO()
+  _get_storage_client().download_blob_to_file(uri, buf)
+  content = buf.getvalue()
+  image_object = Image.open(io.BytesIO(content))
+  max_size_bytes = max_size_megabytes * 1024 * 1024
+  tiles = _call_vision_api_helper(image_object, content, overlap,
+                                  max_size_bytes)
+  images = list(_leaves(tiles))
+  if scratch_bucket and len(images) > _MAX_IMAGES_PER_BATCH:
+    responses = _annotate_images_async(images, scratch_bucket)
+  else:
+    responses = _annotate_images(images, max_size_bytes)
+  return _resolve(tiles, iter(responses))
 
 
-def _call_vision_api_helper(image_file, max_size_megabytes, overlap):
+def _call_vision_api_helper(image_object, content, overlap, max_size_bytes):
   """If the file size is larger, divides the image in two before sending to OCR.
 
-  Calls the Vision API OCR directly if the file size is less than 20 MB.
-  If the file size is larger, it divides the original image in two and calls
-  itself recursively until the sub images meet the API size requirements.
+  Keeps the image as a single tile if the file size is less than 20 MB, or
+  if its lossless PNG encoding is. If the original image is still larger, it
+  tries to downscale it under the limit, as long as its shortest edge stays
+  large enough for accurate OCR.
+  Otherwise it divides the original image in two and calls itself
+  recursively until the sub images meet the API size requirements.
+  Sub images whose raw pixels fit are encoded in the background; larger ones
+  are encoded to check their actual size before being split further.
+  No OCR happens here; the tiles are sent with `_annotate_images` and the
+  responses are merged back with `_resolve`.
 
   Args:
-    image_file: Path to image file.
-    max_size_megabytes: Max size of a file specified by the Vision API.
+    image_object: PIL image.
+    content: Encoded bytes of the image, or None for a sub image.
     overlap: Customizable overlap percentage.
+    max_size_bytes: Max size of a file specified by the Vision API.
 
   Returns:
-    The Vision API response.
+    A tile, or a tuple of (offset, first, second, axis) describing how to
+    merge the responses of two sub trees.
   """
-  image_object = Image.open(image_file)
   width, height = image_object.size
-  file_size = os.path.getsize(image_file)
-  max_size_bytes = max_size_megabytes * 1024 * 1024
+  if content is not None and len(content) < max_size_bytes:
+    return _Tile(content)
 
-  with io.open(image_file, 'rb') as im_file:
-    content = im_file.read()
+  if content is None and _raw_size(image_object) < max_size_bytes:
+    # Encoding releases the GIL, so sibling tiles are encoded in parallel.
+    return _Tile(_EXECUTOR.submit(_encode, image_object))
 
-  if file_size < max_size_bytes:
-    image = vision.types.Image(content=content)
-    response = vision_client.document_text_detection(image=image)
-    return response
+  # The raw size overshoots the PNG size of scanned maps by several times,
+  # and the source encoding may be larger than PNG, so try the lossless
+  # full resolution encoding before downscaling or splitting.
+  encoded = _encode(image_object)
+  if len(encoded) < max_size_bytes:
+    return _Tile(encoded)
 
-  elif width >= height:
-    left_file, right_file, offset = _divide_image_left_and_right(image_file,
-                                                                 overlap)
-    os.remove(image_file)
-    left_response = _call_vision_api_helper(left_file, max_size_bytes,
-                                            overlap)
+  # Only the original image is downscaled; split tiles keep full resolution.
+  if content is not None:
+    tile = _downscale(image_object, len(encoded), max_size_bytes)
+    if tile:
+      return tile
 
-    right_response = _call_vision_api_helper(right_file, max_size_bytes,
-                                             overlap)
+  if width >= height:
+    left, right, offset = _divide_image_left_and_right(image_object, overlap)
+    left_tiles = _call_vision_api_helper(left, None, overlap, max_size_bytes)
+
+    right_tiles = _call_vision_api_helper(right, None, overlap,
+                                          max_size_bytes)
+
+    return (offset, left_tiles, right_tiles, Axis.HORIZONTAL)
+
+  else:
+    top, bottom, offset = _divide_image_top_and_bottom(image_object, overlap)
+    top_tiles = _call_vision_api_helper(top, None, overlap, max_size_bytes)
+
+    bottom_tiles = _call_vision_api_helper(bottom, None, overlap,
+                                           max_size_bytes)
+    return (offset, top_tiles, bottom_tiles, Axis.VERTICAL)
 
-    response = _merge_responses(offset, left_response, right_response,
-                                Axis.HORIZONTAL)
-    return response
 
+def _downscale(image_object, encoded_size, max_size_bytes):
+  """Downscales the image so that it fits in a single Vision API request.
+
+  Args:
+    image_object: PIL image.
+    encoded_size: Size of the full resolution PNG encoding in bytes.
+    max_size_bytes: Max size of a file specified by the Vision API.
+
+  Returns:
+    A downscaled tile, or None if the image would become too small for
+    accurate OCR or still does not fit.
+  """
+  width, height = image_object.size
+  scale = min(1.0, math.sqrt(max_size_bytes / encoded_size) * 0.95)
+  size = (int(width * scale), int(height * scale))
+  if min(size) < _MIN_OCR_EDGE:
+    return None
+  content = _encode(image_object.resize(size, Image.LANCZOS))
+  if len(content) >= max_size_bytes:
+    return None
+  return _Tile(content, scale)
+
+
+def _raw_size(image_object):
+  """Returns the raw pixel size of the image, roughly an upper bound for its PNG."""
+  width, height = image_object.size
+  return width * height * len(image_object.getbands())
+
+
+def _encode(image_object):
+  """Encodes a PIL image as lossless PNG bytes, favoring speed over size."""
+  if image_object.mode not in _PNG_MODES:
+    # PNG cannot store modes such as CMYK.
+    image_object = image_object.convert('RGB')
+  buf = io.BytesIO()
+  image_object.save(buf, format='PNG', compress_level=1, optimize=False)
+  return buf.getvalue()
+
+
+def _leaves(tiles):
+  """Yields the images of a tile tree in depth first, left to right order."""
+  if isinstance(tiles, tuple):
+    _, first, second, _ = tiles
+    for image in _leaves(first):
+      yield image
+    for image in _leaves(second):
+      yield image
   else:
-    top_file, bottom_file, offset = _divide_image_top_and_bottom(image_file,
-                                                                 overlap)
-    os.remove(image_file)
-    top_response = _call_vision_api_helper(top_file, max_size_bytes,
-                                           overlap)
-
-    bottom_response = _call_vision_api_helper(bottom_file, max_size_bytes,
-                                              overlap)
-    response = _merge_responses(offset, bottom_response, top_response,
-                                Axis.VERTICAL)
+    yield tiles.image
+
+
+def _annotate_images(images, max_size_bytes):
+  """Runs document text detection on the images using batched requests.
+
+  Images are grouped into BatchAnnotateImages calls of at most 16 images and
+  at most `max_size_bytes` of content, and the batches are sent concurrently.
+
+  Args:
+    images: Vision API images.
+    max_size_bytes: Max total content size of a single batch.
+
+  Returns:
+    The Vision API responses, in the same order as the images.
+  """
+  feature = vision.types.Feature(
+      type=vision.enums.Feature.Type.DOCUMENT_TEXT_DETECTION)
+  batches = []
+  batch = []
+  batch_size = 0
+  for image in images:
+    image_size = len(image.content)
+    if batch and (len(batch) == _MAX_IMAGES_PER_BATCH or
+                  batch_size + image_size > max_size_bytes):
+      batches.append(batch)
+      batch = []
+      batch_size = 0
+    batch.append(vision.types.AnnotateImageRequest(image=image,
+                                                   features=[feature]))
+    batch_size += image_size
+  if batch:
+    batches.append(batch)
+
+  client = clients.get_vision_client()
+  pending = [_EXECUTOR.submit(client.batch_annotate_images, requests=batch,
+                             retry=clients.RETRY,
+                             timeout=clients.TIMEOUT_SECONDS)
+             for batch in batches]
+  responses = []
+  for future in pending:
+    responses.extend(future.result().responses)
+  return responses
+
+
+def _annotate_images_async(images, bucket_name):
+  """Runs document text detection on the images as one asynchronous batch.
+
+  The images are uploaded to a scratch folder in the bucket, OCR runs on the
+  server side with results written back to the bucket, and the scratch
+  folder is removed once the results are read.
+
+  Args:
+    images: Vision API images.
+    bucket_name: Cloud Storage bucket used for the tiles and the results.
+
+  Returns:
+    The Vision API responses, in the same order as the images.
+  """
+  bucket = _get_storage_client().bucket(bucket_name)
+  prefix = 'geolocalizer/{}/'.format(uuid.uuid4())
+  feature = vision.types.Feature(
+      type=vision.enums.Feature.Type.DOCUMENT_TEXT_DETECTION)
+  blobs = [bucket.blob('{}tiles/{}'.format(prefix, index))
+           for index in range(len(images))]
+  try:
+    uploads = [_EXECUTOR.submit(blob.upload_from_string, image.content)
+               for blob, image in zip(blobs, images)]
+    for upload in uploads:
+      upload.result()
+
+    requests = []
+    for blob in blobs:
+      image = vision.types.Image()
+      image.source.image_uri = 'gs://{}/{}'.format(bucket_name, blob.name)
+      requests.append(vision.types.AnnotateImageRequest(image=image,
+                                                        features=[feature]))
+    output_config = vision.types.OutputConfig(
+        gcs_destination=vision.types.GcsDestination(
+            uri='gs://{}/{}output/'.format(bucket_name, prefix)),
+        batch_size=_MAX_RESPONSES_PER_OUTPUT_FILE)
+    operation = clients.get_vision_client().async_batch_annotate_images(
+        requests=requests, output_config=output_config, retry=clients.RETRY,
+        timeout=clients.TIMEOUT_SECONDS)
+    operation.result(timeout=_ASYNC_TIMEOUT_SECONDS)
+
+    # Output files are named output-<first>-to-<last>.json.
+    outputs = list(bucket.list_blobs(prefix=prefix + 'output/'))
+    outputs.sort(key=lambda output: int(
+        output.name.rsplit('output-', 1)[1].split('-', 1)[0]))
+    responses = []
+    for output in outputs:
+      batch = json_format.Parse(output.download_as_bytes(),
+                                vision.types.BatchAnnotateImagesResponse(),
+                                ignore_unknown_fields=True)
+      responses.extend(batch.responses)
+    return responses
+  finally:
+    # Listed by prefix so outputs are removed even if the operation failed.
+    # Cleanup errors are only logged so they never mask the original error.
+    try:
+      scratch_blobs = list(bucket.list_blobs(prefix=prefix))
+    except exceptions.GoogleAPICallError as error:
+      logging.warning('Could not list scratch blobs under %s: %s', prefix,
+                      error)
+      scratch_blobs = []
+    for blob in scratch_blobs:
+      try:
+        blob.delete()
+      except exceptions.GoogleAPICallError as error:
+        logging.warning('Could not delete scratch blob %s: %s', blob.name,
+                        error)
+
+
+def _resolve(tiles, responses):
+  """Merges the OCR responses of a tile tree into a single response.
+
+  Args:
+    tiles: The tile tree returned by `_call_vision_api_helper`.
+    responses: Iterator over the responses, in `_leaves` order.
+
+  Returns:
+    The Vision API response.
+  """
+  if not isinstance(tiles, tuple):
+    response = next(responses)
+    if response.error.code:
+      raise Exception('Something went wrong with the Vision API:' +
+                      str(response.error))
+    if tiles.scale != 1.0:
+      _rescale(response, 1 / tiles.scale)
     return response
+  offset, first, second, axis = tiles
+  first_response = _resolve(first, responses)
+  second_response = _resolve(second, responses)
+  return _merge_responses(offset, first_response, second_response, axis)
 
 
-def _divide_image_left_and_right(image_file, overlap):
+def _divide_image_left_and_right(image_object, overlap):
   """Takes in an image and divides it vertically according to the overlap.
 
   Args:
-    image_file: Image file.
+    image_object: PIL image.
     overlap: Customizable overlap percentage.
 
   Returns:
-    A left file, right file and the offset to later
+    A left image, right image and the offset to later
     be added when merging responses.
   """
-  image_object = Image.open(image_file)
   width, height = image_object.size
   x_overlap = width * overlap
 
@@ -143,31 +388,25 @@ def _divide_image_left_and_right(image_file, overlap):
   left_sub_image = (0, 0, left_x, height)
   right_sub_image = (right_x, 0, width, height)
 
+  # Decode once so that both crops share the pixel data.
+  image_object.load()
   left = image_object.crop(left_sub_image)
   right = image_object.crop(right_sub_image)
 
-  left_file = 'tmp/{}.jpg'.format(str(uuid.uuid4()))
-  left.save(left_file)
-
-  right_file = 'tmp/{}.jpg'.format(str(uuid.uuid4()))
-  right.save(right_file)
+  return left, right, offset
 
-  return left_file, right_file, offset
 
-
-def _divide_image_top_and_bottom(image_file, overlap):
+def _divide_image_top_and_bottom(image_object, overlap):
   """Takes in an image and divides it horizontally according to the overlap.
 
   Args:
-    image_file: Image file.
+    image_object: PIL image.
     overlap: Customizable overlap percentage.
 
   Returns:
-    A top file, bottom file and the offset to later
+    A top image, bottom image and the offset to later
     be added when merging responses.
   """
-
-  image_object = Image.open(image_file)
   width, height = image_object.size
   y_overlap = height * overlap
 
@@ -178,31 +417,49 @@ def _divide_image_top_and_bottom(image_file, overlap):
   top_sub_image = (0, 0, width, top_y)
   bottom_sub_image = (0, bottom_y, width, height)
 
+  # Decode once so that both crops share the pixel data.
+  image_object.load()
   top = image_object.crop(top_sub_image)
   bottom = image_object.crop(bottom_sub_image)
 
-  top_file = 'tmp/{}.jpg'.format(str(uuid.uuid4()))
-  top.save(top_file)
+  return top, bottom, offset
 
-  bottom_file = 'tmp/{}.jpg'.format(str(uuid.uuid4()))
-  bottom.save(bottom_file)
 
-  return top_file, bottom_file, offset
-
-
-def _add_offset(offset, element, axis):
-  """Adds the offset to the x coordinates of the feature bounding boxes.
+def _add_offset(offset, element, coordinate):
+  """Adds the offset to one coordinate of the feature bounding boxes.
 
   Args:
-    offset: Right sub image upper x value.
+    offset: Right or bottom sub image upper x or y value.
     element: Document features from the API response.
-    axis: The axis to which the offset will be added.
+    coordinate: The vertex field, 'x' or 'y', to which the offset is added.
   """
   for vertex in element.bounding_box.vertices:
-    if axis == Axis.HORIZONTAL:
-      vertex.x += offset
-    if axis == Axis.VERTICAL:
-      vertex.y += offset
+    setattr(vertex, coordinate, getattr(vertex, coordinate) + offset)
+
+
+def _rescale(response, factor):
+  """Maps the coordinates of a downscaled image back to the original image.
+
+  Args:
+    response: Vision API response of the downscaled image.
+    factor: Ratio of the original size to the downscaled size.
+  """
+  def rescale(element):
+    for vertex in element.bounding_box.vertices:
+      vertex.x = int(round(vertex.x * factor))
+      vertex.y = int(round(vertex.y * factor))
+
+  for page in response.full_text_annotation.pages:
+    page.width = int(round(page.width * factor))
+    page.height = int(round(page.height * factor))
+    for block in page.blocks:
+      for paragraph in block.paragraphs:
+        for word in paragraph.words:
+          for symbol in word.symbols:
+            rescale(symbol)
+          rescale(word)
+        rescale(paragraph)
+      rescale(block)
 
 
 def _merge_responses(offset, sub_response1, sub_response2, axis):
@@ -210,12 +467,12 @@ def _merge_responses(offset, sub_response1, sub_response2, axis):
 
   Args:
     offset: The image's x or y start point on the original image.
-    sub_response1: Vision API response from the left or bottom image file.
-    sub_response2: Vision API response from the right or top image file.
+    sub_response1: Vision API response from the left or top image.
+    sub_response2: Vision API response from the right or bottom image.
     axis: Merge direction.
 
   Returns:
-    Full text annotations merged response.
+    sub_response1, with the full text annotations of both responses.
   """
   response1_text = sub_response1.full_text_annotation.text
   response2_text = sub_response2.full_text_annotation.text
@@ -224,23 +481,21 @@ def _merge_responses(offset, sub_response1, sub_response2, axis):
 
   sub_response1.full_text_annotation.text = merged_text
 
-  custom_merged = {'full_text_annotation': sub_response1.full_text_annotation}
-
-  merged_response = custom_merged['full_text_annotation']
+  merged_response = sub_response1.full_text_annotation
 
-  if axis == Axis.HORIZONTAL:
-    add_offset_partial = partial(_add_offset, axis=Axis.HORIZONTAL)
-  elif axis == Axis.VERTICAL:
-    add_offset_partial = partial(_add_offset, axis=Axis.VERTICAL)
+  # The Axis values name the vertex field to shift.
+  coordinate = axis.value
 
-  for page in sub_response2.full_text_annotation.pages:
+  pages = sub_response2.full_text_annotation.pages
+  for page in pages:
     for block in page.blocks:
       for paragraph in block.paragraphs:
         for word in paragraph.words:
           for symbol in word.symbols:
-            add_offset_partial(offset, symbol)
-          add_offset_partial(offset, word)
-        add_offset_partial(offset, paragraph)
-      add_offset_partial(offset, block)
-    merged_response.pages.append(page)
-  return custom_merged
+            _add_offset(offset, symbol, coordinate)
+          _add_offset(offset, word, coordinate)
+        _add_offset(offset, paragraph, coordinate)
+      _add_offset(offset, block, coordinate)
+  # Copies all the pages in a single native call.
+  merged_response.pages.extend(pages)
+  return sub_response1
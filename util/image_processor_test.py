@@ -0,0 +1,181 @@
+# Copyright 2021 The Kartta Labs Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the tiling and merging in image_processor."""
+import io
+import os
+
+import pytest
+
+Image = pytest.importorskip('PIL.Image')
+vision = pytest.importorskip('google.cloud.vision')
+
+from util import image_processor
+from util.image_processor import Axis
+
+
+class FakeVisionClient(object):
+  """Records batch requests and answers each image with its own bytes."""
+
+  def __init__(self):
+    self.batch_sizes = []
+
+  def batch_annotate_images(self, requests, retry=None, timeout=None):
+    del retry, timeout  # Unused.
+    self.batch_sizes.append(len(requests))
+    batch = vision.types.BatchAnnotateImagesResponse()
+    for request in requests:
+      response = batch.responses.add()
+      response.full_text_annotation.text = request.image.content.decode()
+    return batch
+
+
+def _noise_image(width, height):
+  """Returns an image that PNG cannot compress, so its size is predictable."""
+  return Image.frombytes('RGB', (width, height),
+                         os.urandom(width * height * 3))
+
+
+def _png(image_object):
+  buf = io.BytesIO()
+  image_object.save(buf, format='PNG')
+  return buf.getvalue()
+
+
+def _leaf_sizes(tiles):
+  return [Image.open(io.BytesIO(image.content)).size
+          for image in image_processor._leaves(tiles)]
+
+
+def _response(x, y, text=''):
+  """Returns a response with one block, and one symbol, at (x, y)."""
+  response = vision.types.AnnotateImageResponse()
+  response.full_text_annotation.text = text
+  block = response.full_text_annotation.pages.add().blocks.add()
+  block.bounding_box.vertices.add(x=x, y=y)
+  symbol = block.paragraphs.add().words.add().symbols.add()
+  symbol.bounding_box.vertices.add(x=x, y=y)
+  return response
+
+
+def _block_vertices(response):
+  return [(block.bounding_box.vertices[0].x, block.bounding_box.vertices[0].y)
+          for page in response.full_text_annotation.pages
+          for block in page.blocks]
+
+
+def _symbol_vertices(response):
+  return [(symbol.bounding_box.vertices[0].x,
+           symbol.bounding_box.vertices[0].y)
+          for page in response.full_text_annotation.pages
+          for block in page.blocks
+          for paragraph in block.paragraphs
+          for word in paragraph.words
+          for symbol in word.symbols]
+
+
+def test_wide_image_splits_left_to_right():
+  image_object = _noise_image(400, 200)
+  tiles = image_processor._call_vision_api_helper(
+      image_object, _png(image_object), 0.25, 100000)
+
+  offset, left, right, axis = tiles
+  assert (offset, axis) == (150, Axis.HORIZONTAL)
+  assert (left[0], left[3]) == (93, Axis.HORIZONTAL)
+  assert (right[0], right[3]) == (93, Axis.HORIZONTAL)
+  assert _leaf_sizes(tiles) == [(156, 200), (157, 200), (156, 200),
+                                (157, 200)]
+
+
+def test_tall_image_splits_top_to_bottom():
+  image_object = _noise_image(200, 400)
+  tiles = image_processor._call_vision_api_helper(
+      image_object, _png(image_object), 0.25, 100000)
+
+  offset, top, bottom, axis = tiles
+  assert (offset, axis) == (150, Axis.VERTICAL)
+  assert (top[0], top[3]) == (93, Axis.VERTICAL)
+  assert (bottom[0], bottom[3]) == (93, Axis.VERTICAL)
+  assert _leaf_sizes(tiles) == [(200, 156), (200, 157), (200, 156),
+                                (200, 157)]
+
+
+def test_leaves_keep_the_pixels_of_their_crop():
+  image_object = _noise_image(400, 200)
+  tiles = image_processor._call_vision_api_helper(
+      image_object, _png(image_object), 0.25, 100000)
+
+  leaves = list(image_processor._leaves(tiles))
+  first = Image.open(io.BytesIO(leaves[0].content))
+  last = Image.open(io.BytesIO(leaves[-1].content))
+  assert first.tobytes() == image_object.crop((0, 0, 156, 200)).tobytes()
+  assert last.tobytes() == image_object.crop((243, 0, 400, 200)).tobytes()
+
+
+def test_resolve_applies_nested_offsets():
+  tile = image_processor._Tile(b'')
+  tiles = (100,
+           (30, tile, tile, Axis.HORIZONTAL),
+           (30, tile, tile, Axis.HORIZONTAL),
+           Axis.VERTICAL)
+  responses = [_response(1, 1, text) for text in ('a', 'b', 'c', 'd')]
+
+  merged = image_processor._resolve(tiles, iter(responses))
+
+  expected = [(1, 1), (31, 1), (1, 101), (31, 101)]
+  assert _block_vertices(merged) == expected
+  assert _symbol_vertices(merged) == expected
+  assert merged.full_text_annotation.text == 'a b c d'
+
+
+def test_resolve_rescales_downscaled_tiles():
+  response = _response(10, 20)
+  response.full_text_annotation.pages[0].width = 50
+  response.full_text_annotation.pages[0].height = 60
+
+  merged = image_processor._resolve(image_processor._Tile(b'', 0.5),
+                                    iter([response]))
+
+  page = merged.full_text_annotation.pages[0]
+  assert (page.width, page.height) == (100, 120)
+  assert _block_vertices(merged) == [(20, 40)]
+  assert _symbol_vertices(merged) == [(20, 40)]
+
+
+def test_annotate_images_splits_batches_at_sixteen_images(monkeypatch):
+  client = FakeVisionClient()
+  monkeypatch.setattr(image_processor.clients, 'get_vision_client',
+                      lambda: client)
+  images = [vision.types.Image(content=str(index).encode())
+            for index in range(20)]
+
+  responses = image_processor._annotate_images(images, 1024)
+
+  assert sorted(client.batch_sizes) == [4, 16]
+  assert [response.full_text_annotation.text for response in responses] == [
+      str(index) for index in range(20)]
+
+
+def test_annotate_images_splits_batches_at_the_size_cap(monkeypatch):
+  client = FakeVisionClient()
+  monkeypatch.setattr(image_processor.clients, 'get_vision_client',
+                      lambda: client)
+  images = [vision.types.Image(content=letter * 40)
+            for letter in (b'a', b'b', b'c')]
+
+  responses = image_processor._annotate_images(images, 100)
+
+  assert sorted(client.batch_sizes) == [1, 2]
+  assert [response.full_text_annotation.text for response in responses] == [
+      'a' * 40, 'b' * 40, 'c' * 40]